@@ -4,21 +4,89 @@ from typing import List
 import pandas as pd
 from pyspark.sql.dataframe import DataFrame as DF
 from pyspark.sql.window import Window
+from pyspark.sql.pandas.types import to_arrow_schema
+import pyarrow as pa
+import pyarrow.compute as pc
 
 
 
-def aggregate_spatially( sdf: DF, year: int, value_col_name: str, area_col_name: str, full_area_list: DF ) -> pd.DataFrame:
+def collect_arrow( sdf: DF ) -> pa.Table:
     """
-    Returns a pandas DataFrame containing the mean, standard deviation, and number of considered stations for each *area* in the given *year*.
-    There might be areas without measurements. These are also included (via full_area_list), but have NaNs in both mean and stddev, as well
-    as 0 in the number of stations. Also areas with data maz have a NaN in stddev, in case they have only one datum.
+    Collects a Spark DataFrame to the driver as Arrow record batches. Requires spark.sql.execution.arrow.pyspark.enabled.
 
     ---
     sdf: Spark DataFrame
-    Spark Data frame containing all measurements.
+    The (small) Spark DataFrame to be collected.
 
-    year: int
-    The year to be considered.
+    ---
+    returns: pa.Table
+    The collected data.
+    """
+    batches = sdf._collect_as_arrow()
+    if batches:
+        table = pa.Table.from_batches( batches )
+    else:
+        table = to_arrow_schema( sdf.schema ).empty_table()
+
+    return table
+
+
+
+def to_pandas_arrow( sdf: DF ) -> pd.DataFrame:
+    """
+    Collects a Spark DataFrame to the driver as Arrow record batches and converts them into a pandas DataFrame. The columns of the result use the
+    Arrow dtype backend, so numeric columns are not copied once more on conversion.
+
+    ---
+    sdf: Spark DataFrame
+    The (small) Spark DataFrame to be collected.
+
+    ---
+    returns: pd.DataFrame
+    The collected data.
+    """
+    return collect_arrow( sdf ).to_pandas( types_mapper=pd.ArrowDtype, split_blocks=True, self_destruct=True )
+
+
+
+def add_mean_and_stddev( pdf: pd.DataFrame ) -> pd.DataFrame:
+    """
+    Computes the mean and the standard deviation from the number of values, their sum, and the sum of their squares. These are aggregated
+    by Spark in a single pass, while the remaining arithmetics are done here on the small result.
+
+    ---
+    pdf: pd.DataFrame
+    DataFrame with the columns cols.stations, cols.sum, and cols.sum_squares.
+
+    ---
+    returns: pd.DataFrame
+    The DataFrame with the columns cols.mean and cols.stddev instead of cols.sum and cols.sum_squares. The mean is NaN if there is no value,
+    the standard deviation is NaN if there are less than two values.
+    """
+    stations = pdf[cols.stations]
+    n = stations.where( stations > 0 )
+    s1 = pdf[cols.sum]
+    s2 = pdf[cols.sum_squares]
+
+    pdf[cols.mean] = s1 / n
+    variance = ( s2 - s1 * s1 / n ) / ( stations - 1 ).where( stations > 1 )
+    # rounding errors may render the variance of (almost) constant values slightly negative
+    pdf[cols.stddev] = variance.clip( lower=0 ) ** 0.5
+
+    return pdf.drop( columns=[cols.sum, cols.sum_squares] )
+
+
+
+def precompute_cube( sdf: DF, value_col_name: str, area_col_name: str, area_first: bool = True ) -> pa.Table:
+    """
+    Aggregates the number of values, their sum, and the sum of their squares for each combination of year and area in a single Spark job.
+    Also computes the 7-year running mean of each area. The result is small (years times areas) and kept as an Arrow table on the driver.
+    aggregate_spatially, aggregate_temporarly, and aggregate_running_mean slice their views from it with Arrow compute kernels, instead of
+    scanning all measurements again for each year or area.
+
+    ---
+    sdf: Spark DataFrame
+    Spark Data frame containing all measurements.
 
     value_col_name: str
     Name of the column with the data of interest. There are several eligible columns.
@@ -27,117 +95,136 @@ def aggregate_spatially( sdf: DF, year: int, value_col_name: str, area_col_name:
     The column of interest in the input DataFrame. The column contains the area names. There are several of eligible columns, one for each level
     of detail.
 
-    full_area_list: Spark DataFrame
-    One-columned Spark DataFrame containung the list of all possible area names.
+    area_first: bool
+    Whether there are more areas than years. The key with more distinct values comes first when grouping, which spreads the hashes of the
+    groups more evenly.
 
     ---
-    returns: pd.DataFarme
-    A pandas with data for visualization.
+    returns: pa.Table
+    An Arrow table with the columns cols.year, cols.area, cols.stations, cols.sum, cols.sum_squares, and cols.running.
     """
-
-    # pdf = sdf.where( (col(area_col_name).isNotNull()) & (col(cols.year) == year) ) \
-    pdf = sdf.where( col(area_col_name).isNotNull() ) \
-        .where( col(cols.year) == year ) \
-        .where( col(value_col_name).isNotNull() ) \
-        .groupby( area_col_name ) \
+    # the measurements are single precision, but the sum of squares needs double precision
+    value = col(value_col_name).cast('double')
+    group_keys = [area_col_name, cols.year] if area_first else [cols.year, area_col_name]
+    # 7-year-window from six years ago to this year. The window runs over one row per year instead of over all measurements, and the areas
+    # are processed in parallel. Summing up before dividing weights each measurement equally
+    window = Window.partitionBy( cols.area ).orderBy( cols.year ).rangeBetween( -6, Window.currentRow )
+    running_count = sum( cols.stations ).over( window )
+    sdf_agg = sdf.where( col(area_col_name).isNotNull() ) \
+        .groupby( *group_keys ) \
         .agg(
-            mean( value_col_name ).alias( cols.mean ),
-            stddev( value_col_name ).alias( cols.stddev ),
-            count( value_col_name ).alias( cols.stations )
+            count( value_col_name ).alias( cols.stations ),
+            sum( value ).alias( cols.sum ),
+            sum( value * value ).alias( cols.sum_squares )
         ) \
         .withColumnRenamed( area_col_name, cols.area ) \
-        .join( full_area_list, on = cols.area, how = 'outer' ) \
-        .fillna( 0, cols.stations ) \
-        .toPandas()
+        .withColumn( cols.running, when( running_count > 0, sum( cols.sum ).over( window ) / running_count ) )
+    cube = collect_arrow( sdf_agg )
+
+    return cube
+
+
+
+def aggregate_spatially( cube: pa.Table, year: int, area_names: List[str] ) -> pd.DataFrame:
+    """
+    Returns a pandas DataFrame containing the mean, standard deviation, and number of considered stations for each *area* in the given *year*.
+    There might be areas without measurements. These are also included (via area_names), but have NaNs in both mean and stddev, as well
+    as 0 in the number of stations. Also areas with data maz have a NaN in stddev, in case they have only one datum.
+
+    ---
+    cube: pa.Table
+    The aggregated measurements for each year and area, see precompute_cube.
+
+    year: int
+    The year to be considered.
+
+    area_names: List[str]
+    List of all possible area names.
+
+    ---
+    returns: pd.DataFarme
+    A pandas with data for visualization.
+    """
+    table = cube.filter( pc.equal( cube[cols.year], year ) ) \
+        .select( [cols.area, cols.stations, cols.sum, cols.sum_squares] )
+    pdf = table.to_pandas( types_mapper=pd.ArrowDtype, split_blocks=True ) \
+        .set_index( cols.area ) \
+        .reindex( area_names ) \
+        .rename_axis( cols.area ) \
+        .reset_index()
+    pdf[cols.stations] = pdf[cols.stations].fillna( 0 )
+    pdf = add_mean_and_stddev( pdf )
 
     return pdf
 
 
 
-def aggregate_temporarly( sdf: DF, value_col_name: str, area: str, area_col_name: str, sdf_years: DF ) -> pd.DataFrame:
+def aggregate_temporarly( cube: pa.Table, area: str, years: List[int] ) -> pd.DataFrame:
     """
     Returns a pandas DataFrame containing the mean, standard deviation, and number of considered stations for each *year* in the given *area*.
-    There might be years without measurements. These are also included (via sdf_years), but have NaNs in both mean and stddev, as well
+    There might be years without measurements. These are also included (via years), but have NaNs in both mean and stddev, as well
     as 0 in the number of stations. Also, years with data may have a NaN in stddev, in case they have only one datum.
 
     ---
-    sdf: Spark DataFrame
-    Spark Data frame containing all measurements.
-
-    value_col_name: str
-    Name of column with the data of interest.
+    cube: pa.Table
+    The aggregated measurements for each year and area, see precompute_cube.
 
     area: str
     The area to be considered.
 
-    area_col_name:
-    The column of interest in the input DataFrame. The column contains the area names. There are several of eligible columns, one for each level
-    of detail.
-
-    sdf_years: Spark DataFrame
-    One-columned Spark DataFrame containing the list of all possible years.
+    years: List[int]
+    List of all possible years.
 
     ---
     returns: pd.DataFarme
     A pandas with data for visualization.
     """
-
-    pdf = sdf.where( col(area_col_name) == area ) \
-            .groupby( cols.year ) \
-            .agg(
-                mean( value_col_name ).alias( cols.mean ),
-                stddev( value_col_name ).alias( cols.stddev ),
-                count( value_col_name ).alias( cols.stations )
-            ) \
-            .join( sdf_years, on=cols.year, how='outer' ) \
-            .fillna( 0, cols.stations ) \
-            .sort( cols.year, ascending=True ) \
-            .toPandas()
+    table = cube.filter( pc.equal( cube[cols.area], area ) ) \
+        .select( [cols.year, cols.stations, cols.sum, cols.sum_squares] )
+    pdf = table.to_pandas( types_mapper=pd.ArrowDtype, split_blocks=True ) \
+        .set_index( cols.year ) \
+        .reindex( sorted(years) ) \
+        .rename_axis( cols.year ) \
+        .reset_index()
+    pdf[cols.stations] = pdf[cols.stations].fillna( 0 )
+    pdf = add_mean_and_stddev( pdf )
     
     return pdf
 
 
 
-def aggregate_running_mean( sdf: DF, value_col_name: str, area: str, area_col_name: str, sdf_years: DF ) -> pd.DataFrame:
+def aggregate_running_mean( cube: pa.Table, area: str, years: List[int] ) -> pd.DataFrame:
     """
-    Computes a 5-year running mean for the given area for each year.
+    Returns a pandas DataFrame containing the 7-year running mean for each *year* in the given *area*. Years without measurements in the area
+    have a NaN.
 
     ---
-    sdf: Spark DataFrame
-    Spark Data frame containing all measurements.
-
-    value_col_name: str
-    Name of the column with the data.
+    cube: pa.Table
+    The aggregated measurements for each year and area, see precompute_cube.
 
     area: str
     The area to be considered.
 
-    area_col_name:
-    The column of interest in the input DataFrame. The column contains the area names. There are several of eligible columns, one for each level
-    of detail.
-
-    sdf_years: Spark DataFrame
-    One-columned Spark DataFrame containing the list of all possible years.
+    years: List[int]
+    List of all possible years.
 
     ---
     returns: pd.DataFarme
     A pandas DataFarme with data for visualization.
     """
-    # 7-year-window from six years ago to this years
-    window = Window.orderBy( cols.year ).rangeBetween(-6, Window.currentRow)    
-    pdf = sdf.where( col(area_col_name) == area ) \
-            .withColumn( cols.running, mean( col(value_col_name) ).over(window) ) \
-            .drop_duplicates( [cols.year] ) \
-            .select( [cols.year, cols.running] ) \
-            .join( sdf_years, on = cols.year, how = 'outer') \
-            .sort( cols.year, ascending=True ) \
-            .toPandas()
-    
+    table = cube.filter( pc.equal( cube[cols.area], area ) ) \
+        .select( [cols.year, cols.running] )
+    pdf = table.to_pandas( types_mapper=pd.ArrowDtype, split_blocks=True ) \
+        .set_index( cols.year ) \
+        .reindex( sorted(years) ) \
+        .rename_axis( cols.year ) \
+        .reset_index()
+
     return pdf
 
 
 
-def aggregate_differences( sdf: DF, area: str, area_col_name: str, sdf_years: DF ) -> pd.DataFrame:
+def aggregate_differences( sdf: DF, sdf_years: DF ) -> pd.DataFrame:
     """
     Returns a pandas DataFrame containing the mean, standard deviation, and number of considered stations of the temperature differences to the pivot
     temperatures for each *year* in the given *area*. The pivot temperatures is individual to each station. There might be years without measurements.
@@ -146,14 +233,7 @@ def aggregate_differences( sdf: DF, area: str, area_col_name: str, sdf_years: DF
 
     ---
     sdf: Spark DataFrame
-    Spark Data frame containing all measurements.
-
-    area: str
-    The area to be considered.
-
-    area_col_name:
-    The column of interest in the input DataFrame. The column contains the area names. There are several of eligible columns, one for each level
-    of detail.
+    Spark Data frame containing the measurements of the area to be considered.
 
     sdf_years: Spark DataFrame
     One-columned Spark DataFrame containing the list of all possible years.
@@ -162,18 +242,25 @@ def aggregate_differences( sdf: DF, area: str, area_col_name: str, sdf_years: DF
     returns: pd.DataFarme
     A pandas DataFarme with data for visualization.
     """
-    pdf = sdf.where( col(area_col_name) == area ) \
-            .withColumn( cols.diff, col(cols.temperature) - col(cols.pivot_temp) ) \
+    sdf_diffs = sdf.withColumn( cols.diff, col(cols.temperature) - col(cols.pivot_temp) ) \
             .groupby( cols.year ) \
             .agg(
-                mean( cols.diff ).alias( cols.mean ),
-                stddev( cols.diff ).alias( cols.stddev ),
-                count( cols.diff ).alias( cols.stations )
-            ) \
-            .join( sdf_years, on=cols.year, how='outer' ) \
-            .fillna( 0, cols.stations ) \
-            .sort( cols.year, ascending=True ) \
-            .toPandas()
+                count( cols.diff ).alias( cols.stations ),
+                sum( cols.diff ).alias( cols.sum ),
+                sum( col(cols.diff) * col(cols.diff) ).alias( cols.sum_squares )
+            )
+    # Spark cannot broadcast the side of an outer join whose rows are all kept, so the years are kept and the few aggregated rows
+    # are broadcast
+    sdf_agg = sdf_years.join( broadcast(sdf_diffs), on=cols.year, how='left' ) \
+            .select(
+                cols.year,
+                coalesce( col(cols.stations), lit(0) ).alias( cols.stations ),
+                cols.sum,
+                cols.sum_squares
+            )
+    pdf = add_mean_and_stddev( to_pandas_arrow( sdf_agg ) )
+    # there is one row per year at most, sorting these does not need a distributed sort in Spark
+    pdf = pdf.sort_values( cols.year, kind='stable', ignore_index=True )
     
     return pdf
 
@@ -197,13 +284,15 @@ def get_pivotal_mean( df: DF, start_year: int, end_year: int ) -> DF:
     ---
     returns: spark DataFrame
     A DataFrame containing the station id and its pivotal reference temperature in each row. Note that the temperature is 'null'
-    if no measurements are available for a station in the given interval.
+    if no measurements are available for a station in the given interval. There is only one row per station, so the DataFrame is cached and
+    marked for broadcasting. Joins with the measurements on the station id then avoid shuffling the measurements.
     """
-    pivots = df.where( col(cols.year) >= start_year ) \
-            .where( col(cols.year) <= end_year) \
+    # a single range predicate on the year can be pushed down to the Parquet reader
+    pivots = df.where( col(cols.year).between( start_year, end_year ) ) \
             .groupBy( cols.sdo_id ) \
             .agg(
                 mean( cols.temperature ).alias( cols.pivot_temp )
-            )
+            ) \
+            .cache()
     
-    return pivots
+    return broadcast( pivots )
@@ -10,6 +10,8 @@ stations = 'Stations'
 pivot_temp = 'Pivot Temperature'
 diff = 'Difference to pivot'
 running = 'Running mean'
+sum = 'Sum'
+sum_squares = 'Sum of squares'
 
 sdo_id = 'SDO_ID'
 timestamp = 'Time stamp'
@@ -1,76 +1,320 @@
 import cols
-from shapely.geometry import Polygon, Point
+import numba
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyspark.sql.functions import pandas_udf
+from pyspark.sql.types import StructType, StructField, StringType
 
 
 
-def check_in_polygons(lon: float, lat: float, polygons) -> bool:
+# Translations, because we pick the names from the GeoJSON for the counties. These names do not match the names in the other GeoJSONs
+# in some cases
+nation_dict = {'Germany': 'Deutschland'}
+
+# names of the areas a point is located in, as returned by the UDF of make_find_area_udf
+areas_schema = StructType([
+    StructField( cols.nation, StringType(), True ),
+    StructField( cols.state, StringType(), True ),
+    StructField( cols.county, StringType(), True ),
+    StructField( cols.assignment, StringType(), True ),
+])
+
+# areas already built on this worker, keyed by the building function and the id of the object they have been built
+# from. Each worker rebuilds the areas from the broadcast value once, rather than for each batch
+_cache = {}
+
+
+
+def _get_cached(build, source):
     """
-    Checks if the point (lon, lat) is located within the (multi)polygon.
+    Returns build(source), calling build on the first call for this source only.
 
     ---
-    lon: float
-    Longitude (east/west) in degrees
+    build: Function
+    Function building the object to be cached from the source.
 
-    lat: float
-    Latitude (north/south) in degrees
+    source: Object
+    The object to build from. Spark UDFs should pass the value of the same broadcast variable in each call, so that the object is built once
+    per worker.
 
-    polygon: List
-    A list of lists of two-elemental lists. The latter lists contain the latitude and longitude of the polygon nodes, in degrees.
+    ---
+    returns: Object
+    The result of build(source).
+    """
+    key = (build.__name__, id(source))
+    entry = _cache.get(key)
+    # keeping a reference to the source prevents its id from being reused by another object
+    if entry is None or entry[0] is not source:
+        entry = (source, build(source))
+        _cache[key] = entry
+    return entry[1]
+
+
+
+def _collect_rings(coordinates, rings):
+    """
+    Collects the linear rings of a (multi)polygon as arrays of nodes.
 
     ---
-    returns: bool True if and only if the point is located within the (multi)polygon.
+    coordinates: List
+    The coordinates of the geometry of a GeoJSON feature.
+
+    rings: List
+    The list the rings are appended to. Each ring is an array of shape (N, 2) with the longitudes and latitudes of its nodes, in degrees.
     """
-    if isinstance(polygons, list):
-        for polygon in polygons:
-            # the depth of the nesting of the polygons differs from area to area, so we have to deal with this by recursively
-            # going deeper and deeper
-            if isinstance(polygon, list) and isinstance(polygon[0], list):
-                if not isinstance(polygon[0][0], list):
-                    poly = Polygon(polygon)
-                    return poly.contains( Point(lon, lat) )
-                else:
-                    return check_in_polygons(lon, lat, polygon)
-            else:
-                # invalid argument
-                return False
-    return False
+    # the depth of the nesting of the polygons differs from area to area, so we have to deal with this by recursively going deeper and deeper
+    if isinstance(coordinates[0][0], list):
+        for part in coordinates:
+            _collect_rings(part, rings)
+    else:
+        rings.append( np.asarray(coordinates, dtype=np.float64) )
 
 
 
-def find_area(lon: float, lat: float, geojson):
+def make_areas(geojson):
     """
-    Finds the area in which the point is located and returns the names.
+    Flattens the GeoJSON into NumPy arrays suitable for find_areas_batch. The nodes of all rings of all areas are stored in a single array,
+    offsets tell where each ring and each area starts.
+
+    ---
+    geojson: JSON
+    A GeoJSON containing the areas and their names.
 
     ---
-    lon: float
-    Longitude (east/west) in degrees
+    returns: Tuple
+    An array of shape (N, 2) with the longitudes and latitudes of the nodes of all rings, in degrees; an array with the index of the first node
+    of each ring, plus the total number of nodes; an array with the index of the first ring of each area, plus the total number of rings; an
+    array of shape (F, 4) with the bounding box (min. longitude, min. latitude, max. longitude, max. latitude) of each area; and a list of tuples
+    with the name of the nation, the state, and the county of each area.
+    """
+    rings = []
+    feat_offs = [0]
+    bboxes = []
+    names = []
+    for feature in geojson['features']:
+        feature_rings = []
+        _collect_rings( feature['geometry']['coordinates'], feature_rings )
+        nodes = np.concatenate( feature_rings )
+        rings.extend( feature_rings )
+        feat_offs.append( len(rings) )
+        bboxes.append( (*nodes.min(axis=0), *nodes.max(axis=0)) )
+
+        nation = feature['properties']['NAME_0']
+        nation = nation_dict.get(nation, nation)
+        state = feature['properties']['NAME_1']
+        county = feature['properties']['NAME_3']
+        names.append( (nation, state, county) )
+
+    coords = np.ascontiguousarray( np.concatenate(rings) )
+    poly_offs = np.concatenate( ([0], np.cumsum([len(ring) for ring in rings])) ).astype(np.int64)
+
+    return coords, poly_offs, np.array(feat_offs, dtype=np.int64), np.array(bboxes, dtype=np.float64), names
 
-    lat: float
-    Latitude (north/south) in degrees
 
+
+def _to_ipc(table: pa.Table) -> bytes:
+    """
+    Writes the table into an Arrow IPC stream.
+    """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+
+def serialize_areas(geojson):
+    """
+    Serializes the flattened areas of the GeoJSON into Arrow IPC streams. These are much cheaper to ship to the workers and to load there
+    than the deeply nested GeoJSON. See deserialize_areas for the way back.
+
+    ---
     geojson: JSON
     A GeoJSON containing the areas and their names.
 
     ---
     returns: Tuple
-    A tuple with the name of the nation, the state, and the county the point is located in. If the point is outside of each polygon of the GeoJSON,
-    a tuple of three pandas.NAs is returned instead.
+    Two bytes objects. The first one holds a table with the area id, the ring id, the longitude, and the latitude of each node, stored ring by
+    ring. The second one holds a table with the area id and the name of the nation, the state, and the county of each area.
     """
+    coords, poly_offs, feat_offs, _, names = make_areas(geojson)
+    ring_areas = np.repeat( np.arange(len(feat_offs) - 1, dtype=np.int32), np.diff(feat_offs) )
+    ring_ids = np.repeat( np.arange(len(poly_offs) - 1, dtype=np.int32), np.diff(poly_offs) )
 
-    # Translations, because we pick the names from the GeoJSON for the counties. These names do not match the names in the other GeoJSONs
-    # in some cases
-    nation_dict = {'Germany': 'Deutschland'}
+    coords_table = pa.table({
+        'feature_id': ring_areas[ring_ids],
+        'ring_id': ring_ids,
+        'lon': coords[:, 0],
+        'lat': coords[:, 1],
+    })
+    names_table = pa.table({
+        'feature_id': np.arange(len(names), dtype=np.int32),
+        'nation': [name[0] for name in names],
+        'state': [name[1] for name in names],
+        'county': [name[2] for name in names],
+    })
 
-    for feature in geojson['features']:
-        within_any = check_in_polygons(lon, lat, feature['geometry']['coordinates'])
-        if within_any:
-            # found areas, return
-            nation = feature['properties']['NAME_0']
-            if nation in nation_dict.keys():
-                nation = nation_dict[nation]
-            state = feature['properties']['NAME_1']
-            county = feature['properties']['NAME_3']
-            return (nation, state, county, cols.automated)
-    # no areas found
-    return (None, None, None, cols.automated)
+    return _to_ipc(coords_table), _to_ipc(names_table)
+
+
+
+def deserialize_areas(buffers):
+    """
+    Rebuilds the flattened areas from the Arrow IPC streams created by serialize_areas.
+
+    ---
+    buffers: Tuple
+    The two bytes objects returned by serialize_areas.
+
+    ---
+    returns: Tuple
+    The areas and their names, see make_areas.
+    """
+    coords_table = pa.ipc.open_stream(buffers[0]).read_all()
+    names_table = pa.ipc.open_stream(buffers[1]).read_all()
+
+    lon = coords_table['lon'].to_numpy()
+    lat = coords_table['lat'].to_numpy()
+    coords = np.ascontiguousarray( np.column_stack((lon, lat)) )
+
+    # the nodes are stored ring by ring and the rings area by area, so the offsets follow from the number of nodes of each ring and the
+    # number of rings of each area
+    ring_ids = coords_table['ring_id'].to_numpy()
+    poly_offs = np.concatenate( ([0], np.cumsum(np.bincount(ring_ids))) ).astype(np.int64)
+    ring_areas = coords_table['feature_id'].to_numpy()[poly_offs[:-1]]
+    feat_offs = np.concatenate( ([0], np.cumsum(np.bincount(ring_areas, minlength=names_table.num_rows))) ).astype(np.int64)
+
+    starts = poly_offs[feat_offs[:-1]]
+    bboxes = np.column_stack((
+        np.minimum.reduceat(lon, starts),
+        np.minimum.reduceat(lat, starts),
+        np.maximum.reduceat(lon, starts),
+        np.maximum.reduceat(lat, starts),
+    ))
+    names = list( zip(
+        names_table['nation'].to_pylist(),
+        names_table['state'].to_pylist(),
+        names_table['county'].to_pylist()
+    ) )
+
+    return coords, poly_offs, feat_offs, bboxes, names
+
+
+
+@numba.njit(parallel=True, cache=True, fastmath=True)
+def pip_multi(xs, ys, coords, poly_offs, feat_offs, bboxes):
+    """
+    Finds the area each point is located in, by the even-odd rule: a ray from the point towards the east crosses the boundary of an area an odd
+    number of times if and only if the point is inside. The rule also holds across all rings of an area, which takes care of holes and of areas
+    with several parts. The points are processed in parallel.
+
+    ---
+    xs: np.ndarray
+    Longitudes of the points, in degrees. Must be finite.
+
+    ys: np.ndarray
+    Latitudes of the points, in degrees. Must be finite.
+
+    coords, poly_offs, feat_offs, bboxes:
+    The flattened areas, see make_areas.
+
+    ---
+    returns: np.ndarray
+    The index of the area each point is located in, -1 if the point is outside of each area.
+    """
+    result = np.full( len(xs), -1, dtype=np.int32 )
+    for i in numba.prange( len(xs) ):
+        x = xs[i]
+        y = ys[i]
+        for f in range( len(feat_offs) - 1 ):
+            # only areas with a bounding box containing the point need the exact test
+            if x < bboxes[f, 0] or x > bboxes[f, 2] or y < bboxes[f, 1] or y > bboxes[f, 3]:
+                continue
+
+            inside = False
+            for r in range( feat_offs[f], feat_offs[f+1] ):
+                for k in range( poly_offs[r], poly_offs[r+1] - 1 ):
+                    x1 = coords[k, 0]
+                    y1 = coords[k, 1]
+                    x2 = coords[k+1, 0]
+                    y2 = coords[k+1, 1]
+                    # the edge crosses the line of latitude of the point east of the point
+                    if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                        inside = not inside
+
+            if inside:
+                result[i] = f
+                break
+
+    return result
+
+
+
+# compile the kernel once when the module is loaded on a worker, rather than within the first batch of stations
+pip_multi( np.zeros(1), np.zeros(1), np.zeros((2, 2)), np.array([0, 2], dtype=np.int64), np.array([0, 1], dtype=np.int64), np.zeros((1, 4)) )
+
+
+
+def find_areas(lons: pd.Series, lats: pd.Series, areas) -> pd.DataFrame:
+    """
+    Finds the areas in which the points are located for a whole batch of points at once.
+
+    ---
+    lons: pd.Series
+    Longitudes (east/west) of the points, in degrees.
+
+    lats: pd.Series
+    Latitudes (north/south) of the points, in degrees.
+
+    areas: Tuple
+    The areas and their names, as created by make_areas.
+
+    ---
+    returns: pd.DataFrame
+    A DataFrame with the columns cols.nation, cols.state, cols.county, and cols.assignment, one row for each point. Points outside of each
+    area have Nones in the name columns.
+    """
+    coords, poly_offs, feat_offs, bboxes, names = areas
+    xs = lons.to_numpy( dtype=np.float64, na_value=np.nan )
+    ys = lats.to_numpy( dtype=np.float64, na_value=np.nan )
+
+    # index of the area each point is located in, -1 for none. Points without a proper location are left out, as the kernel relies on
+    # finite coordinates
+    found = np.full( len(xs), -1, dtype=np.int32 )
+    valid = np.isfinite(xs) & np.isfinite(ys)
+    found[valid] = pip_multi( xs[valid], ys[valid], coords, poly_offs, feat_offs, bboxes )
+
+    # the last row serves the points outside of each area
+    lookup = np.array( names + [(None, None, None)], dtype=object )
+    assigned = lookup[found]
+
+    pdf = pd.DataFrame({
+        cols.nation: assigned[:, 0],
+        cols.state: assigned[:, 1],
+        cols.county: assigned[:, 2],
+        cols.assignment: cols.automated
+    })
+    return pdf
+
+
+
+def make_find_area_udf(bc_areas):
+    """
+    Creates a pandas UDF that assigns points to areas. The UDF returns the names of the areas as a single struct column, so each batch of
+    points crosses the boundary between Spark and Python only once.
+
+    ---
+    bc_areas: Broadcast
+    Broadcast variable with the serialized areas and their names, as created by serialize_areas. Each worker deserializes them once.
+
+    ---
+    returns: Function
+    The pandas UDF. It takes the columns with the longitudes and the latitudes, in degrees, and returns a struct with the fields cols.nation,
+    cols.state, cols.county, and cols.assignment.
+    """
+    @pandas_udf( areas_schema )
+    def find_area_udf(lons: pd.Series, lats: pd.Series) -> pd.DataFrame:
+        return find_areas( lons, lats, _get_cached(deserialize_areas, bc_areas.value) )
 
+    return find_area_udf